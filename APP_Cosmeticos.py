@@ -1,11 +1,16 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import re
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import json
+import threading
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from reportlab.platypus import (
     SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer, PageBreak
 )
@@ -17,25 +22,30 @@ from reportlab.lib.units import inch
 # -----------------------------------------------------------
 # FUNCIÓN PARA GENERAR REPORTE PDF
 # -----------------------------------------------------------
+# Estilos y márgenes del reporte: se arman una sola vez al importar el módulo
+PDF_ESTILOS = getSampleStyleSheet()
+PDF_MARGEN  = inch
+# Cada fila de un anexo va en un solo párrafo (un campo por línea) con la
+# separación entre filas como espacio posterior
+PDF_ESTILO_FILA = ParagraphStyle(name='Fila', parent=PDF_ESTILOS['Normal'], spaceAfter=8)
+
 def generar_reporte_pdf(resultados):
     buffer = BytesIO()
     doc = SimpleDocTemplate(
         buffer,
         pagesize=letter,
-        leftMargin=1*inch, rightMargin=1*inch,
-        topMargin=1*inch, bottomMargin=1*inch
+        leftMargin=PDF_MARGEN, rightMargin=PDF_MARGEN,
+        topMargin=PDF_MARGEN, bottomMargin=PDF_MARGEN
     )
-    styles = getSampleStyleSheet()
-    normal = styles['Normal']
-    h2     = styles['Heading2']
-    h3     = styles['Heading3']
-    bold   = ParagraphStyle(name='Bold', parent=normal, fontName='Helvetica-Bold')
+    normal = PDF_ESTILOS['Normal']
+    h2     = PDF_ESTILOS['Heading2']
+    h3     = PDF_ESTILOS['Heading3']
 
     elementos = []
     # Título
     elementos.append(Paragraph(
         "Reporte de Búsqueda de CAS en Anexos de Restricciones",
-        styles['Title']
+        PDF_ESTILOS['Title']
     ))
     elementos.append(Spacer(1, 12))
 
@@ -60,16 +70,15 @@ def generar_reporte_pdf(resultados):
             elementos.append(Paragraph(anexo['nombre'], h3))
             elementos.append(Spacer(1, 4))
 
-            df = anexo['data'].reset_index(drop=True)
-            # Por cada fila del DataFrame
-            for _, row in df.iterrows():
-                # Para cada par columna→valor
-                for col, val in row.items():
-                    texto = f"<b>{col}:</b> {'' if pd.isna(val) else val}"
-                    elementos.append(Paragraph(texto, normal))
-                    elementos.append(Spacer(1, 2))
-                # separación entre filas
-                elementos.append(Spacer(1, 6))
+            df = anexo['data']
+            cols = df.columns.tolist()
+            # Valores nulos ya vacíos y en un array NumPy: ni Series por fila ni pd.isna por celda
+            valores = df.astype(object).where(df.notna(), "").to_numpy()
+            # Por cada fila un único Paragraph con un par columna→valor por línea,
+            # en lugar de un Paragraph y un Spacer por celda
+            for row in valores:
+                texto = "<br/>".join(f"<b>{col}:</b> {val}" for col, val in zip(cols, row))
+                elementos.append(Paragraph(texto, PDF_ESTILO_FILA))
 
     # Construir el PDF
     doc.build(elementos)
@@ -80,183 +89,695 @@ def generar_reporte_pdf(resultados):
 # -----------------------------------------------------------
 # FUNCIÓN PARA CARGAR TODOS LOS ARCHIVOS
 # -----------------------------------------------------------
-@st.cache_data(show_spinner=False)
-def load_data():
-    is_cloud   = os.environ.get('STREAMLIT_SHARING', '') == 'true'
-    base_path  = "." if is_cloud else os.path.dirname(os.path.abspath(__file__))
-    restr_path = os.path.join(base_path, "RESTRICCIONES")
+# Rutas de los datos: se resuelven una sola vez al importar el módulo
+IS_CLOUD           = os.environ.get('STREAMLIT_SHARING', '') == 'true'
+BASE_PATH          = "." if IS_CLOUD else os.path.dirname(os.path.abspath(__file__))
+RESTRICCIONES_PATH = os.path.join(BASE_PATH, "RESTRICCIONES")
+CAS_PATH           = os.path.join(BASE_PATH, "CAS")
 
-    info_carga = []
+# openpyxl en modo solo lectura: recorre las filas en streaming sin
+# construir estilos ni el grafo de fórmulas del libro completo, ni cargar
+# los vínculos a libros externos
+OPENPYXL_KWARGS = {"read_only": True, "data_only": True, "keep_links": False}
+# python-calamine (lector en Rust) es bastante más rápido que openpyxl y además
+# decodifica los "_x000D_" de las celdas; si no está instalado se usa openpyxl
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_KWARGS = {"engine": "calamine"}
+except ImportError:
+    EXCEL_KWARGS = {"engine": "openpyxl", "engine_kwargs": OPENPYXL_KWARGS}
+# Se incrementa cuando cambia la forma de leer los Excel, para descartar los Parquet ya generados
+PARQUET_CACHE_VERSION = 4
 
-    def load_annex(name, filename, skip):
-        # 1) Leer toda la tabla con saltos para datos
-        path = os.path.join(restr_path, filename)
-        df = pd.read_excel(path, skiprows=skip, header=0, engine="openpyxl")
-        df.columns = df.columns.str.strip()
-
-        # 2) Leer SOLO la fila de fallback (la fila justo anterior al header)
-        raw = pd.read_excel(path, header=None, nrows=skip, engine="openpyxl")
-        fallback = raw.iloc[skip-1].tolist()
-
-        # 3) Reemplazar columnas Unnamed por el valor de fallback
-        new_cols = []
-        for idx, col in enumerate(df.columns):
-            if str(col).lower().startswith("unnamed"):
-                # fallback[idx] puede ser nan, así que chequeamos
-                val = fallback[idx]
-                new = str(val).strip() if pd.notna(val) else col
-                new_cols.append(new)
-            else:
-                new_cols.append(col)
-        df.columns = new_cols
-
-        info_carga.append(f"✅ {name}: {len(df)} filas")
-        return df
-
-    annex_ii  = load_annex("Annex II",  "COSING_Annex_II_v2.xlsx",  7)
-    annex_iii = load_annex("Annex III", "COSING_Annex_III_v2.xlsx",7)
-    annex_iv  = load_annex("Annex IV",  "COSING_Annex_IV_v2.xlsx", 7)
-    annex_v   = load_annex("Annex V",   "COSING_Annex_V_v2.xlsx",   7)
-    annex_vi  = load_annex("Annex VI",  "COSING_Annex_VI_v2.xlsx", 7)
-
-    # MERCOSUR Prohibidas
-    mercosur = pd.DataFrame()
+def firma_cache_parquet(xlsx_path):
+    """
+    Identifica la versión del XLSX (y del formato de carga) a la que corresponde un Parquet:
+    fecha de modificación y tamaño, porque una copia que conserva la fecha puede ser otro libro.
+    """
+    estado = os.stat(xlsx_path)
+    return f"{PARQUET_CACHE_VERSION} {EXCEL_KWARGS['engine']} {estado.st_mtime!r} {estado.st_size}"
+
+def leer_cache_parquet(xlsx_path):
+    """
+    Devuelve el DataFrame cacheado en Parquet junto al XLSX, o None si no existe
+    o si el XLSX cambió desde que se generó (firma guardada en un archivo aparte).
+    """
+    cache_path = os.path.splitext(xlsx_path)[0] + ".parquet"
     try:
-        path = os.path.join(restr_path, "07 MERCOSUR_062_2014_PROHIBIDAS.xlsx")
-        # skiprows=5: header fila6, fallback fila5
-        mercosur = pd.read_excel(path, skiprows=5, header=0, engine="openpyxl")
-        mercosur.columns = mercosur.columns.str.strip()
-        raw = pd.read_excel(path, header=None, nrows=5, engine="openpyxl")
-        fallback = raw.iloc[4].tolist()
-        new_cols = []
-        for idx, col in enumerate(mercosur.columns):
-            if str(col).lower().startswith("unnamed"):
-                val = fallback[idx]
-                new_cols.append(str(val).strip() if pd.notna(val) else col)
-            else:
-                new_cols.append(col)
-        mercosur.columns = new_cols
-
-        info_carga.append(f"✅ MERCOSUR Prohibidas: {len(mercosur)} filas")
-    except Exception as e:
-        info_carga.append(f"❌ Error MERCOSUR Prohibidas: {e}")
+        with open(cache_path + ".mtime", "r", encoding="utf-8") as f:
+            firma = f.read().strip()
+        if firma != firma_cache_parquet(xlsx_path):
+            return None
+        return pd.read_parquet(cache_path, engine="pyarrow")
+    except Exception:
+        return None
 
-    # Cargar base de datos CAS - CORREGIDO
-    cas_db = pd.DataFrame()
+def guardar_cache_parquet(xlsx_path, df):
+    """
+    Guarda el DataFrame como Parquet junto al XLSX para evitar re-parsear el Excel
+    en el próximo arranque. Parquet no admite columnas con tipos mezclados, así que
+    en esas columnas los valores no nulos se pasan a texto; se devuelve ese mismo
+    DataFrame para que la primera carga y las siguientes sean idénticas. Si no se
+    puede escribir (p. ej. disco de solo lectura) se ignora y se seguirá leyendo el XLSX.
+    """
+    df = df.copy()
+    df.columns = [str(col) for col in df.columns]
+    for col in df.columns[df.dtypes == object]:
+        no_nulos = df[col].notna()
+        if not df.loc[no_nulos, col].map(lambda v: isinstance(v, str)).all():
+            df.loc[no_nulos, col] = df.loc[no_nulos, col].astype(str)
+
+    cache_path = os.path.splitext(xlsx_path)[0] + ".parquet"
     try:
-        # RUTA CORREGIDA: usar carpeta CAS
-        cas_db_path = os.path.join(base_path, "CAS", "COSING_Ingredients-Fragrance Inventory_v2.xlsx")
-        info_carga.append(f"Intentando cargar CAS desde: {cas_db_path}")
-        
-        # Intentar diferentes configuraciones de skiprows para encontrar la correcta
-        cas_db_loaded = False
-        for skip_rows in [7, 8, 6, 9, 5, 10, 4, 3, 2, 1, 0]:  # Empezar con 7 que es lo más probable
-            try:
-                cas_db_temp = pd.read_excel(cas_db_path, skiprows=skip_rows, header=0, engine="openpyxl")
-                cas_db_temp.columns = cas_db_temp.columns.str.strip()
+        df.to_parquet(cache_path, engine="pyarrow", compression="zstd")
+        with open(cache_path + ".mtime", "w", encoding="utf-8") as f:
+            f.write(firma_cache_parquet(xlsx_path))
+    except Exception:
+        pass
+    return df
+
+def leer_bytes(path):
+    """
+    Lee el archivo completo a memoria en una sola llamada. Los hilos de carga
+    hacen su lectura de disco en paralelo y luego cada libro se parsea una sola
+    vez desde RAM.
+    """
+    with open(path, "rb") as f:
+        return f.read()
+
+# Listados de restricciones: nombre -> (archivo en RESTRICCIONES, filas antes del encabezado).
+# El orden del diccionario es el orden en que se muestran y se buscan
+ANEXOS = {
+    "Annex II":            ("COSING_Annex_II_v2.xlsx",  7),
+    "Annex III":           ("COSING_Annex_III_v2.xlsx", 7),
+    "Annex IV":            ("COSING_Annex_IV_v2.xlsx",  7),
+    "Annex V":             ("COSING_Annex_V_v2.xlsx",   7),
+    "Annex VI":            ("COSING_Annex_VI_v2.xlsx",  7),
+    # skiprows=5: header fila6, fallback fila5
+    "MERCOSUR Prohibidas": ("07 MERCOSUR_062_2014_PROHIBIDAS.xlsx", 5),
+}
+# Filas iniciales de la base CAS en las que se busca el encabezado
+CAS_DB_MAX_FILAS_ENCABEZADO = 20
+# Orden fijo de las tablas que devuelve load_data
+ORDEN_CARGA = [*ANEXOS, "CAS DB"]
+
+def texto_a_arrow(df):
+    """
+    Devuelve el DataFrame con sus columnas de texto como "string[pyarrow]". En pandas 2
+    llegan como object y en pandas 3 como "str"; se incluyen ambas.
+    """
+    columnas_texto = df.select_dtypes(include=["object", "string"]).columns
+    return df.astype({col: "string[pyarrow]" for col in columnas_texto})
+
+def deduplicar_nombres(nombres):
+    """
+    Renombra los nombres repetidos como "X.1", "X.2"... igual que pandas al leer
+    con header=0, sin chocar con un "X.1" que ya venga en el encabezado.
+    """
+    nombres = list(nombres)
+    contador = {}
+    for idx, col in enumerate(nombres):
+        original = col
+        n = contador.get(col, 0)
+        if n > 0:
+            while n > 0:
+                contador[original] = n + 1
+                col = f"{original}.{n}"
+                if col in nombres:
+                    n += 1
+                else:
+                    n = contador.get(col, 0)
+            nombres[idx] = col
+        contador[col] = n + 1
+    return nombres
+
+def nombres_de_columnas(encabezado, fallback=()):
+    """
+    Nombres de columna a partir de la fila de encabezado: las celdas vacías toman
+    el valor de la fila de fallback o, si tampoco hay, "Unnamed: i". Los repetidos
+    se numeran con deduplicar_nombres.
+    """
+    fallback = list(fallback)
+    fallback += [None] * (len(encabezado) - len(fallback))
+    nombres = []
+    for idx, (col, val) in enumerate(zip(encabezado, fallback)):
+        if pd.notna(col) and str(col).strip():
+            nombres.append(str(col).strip())
+        elif pd.notna(val):
+            nombres.append(str(val).strip())
+        else:
+            nombres.append(f"Unnamed: {idx}")
+    return deduplicar_nombres(nombres)
+
+# Celdas de fecha leídas con dtype=str: "2020-06-16 00:00:00"
+FECHA_CON_HORA_RE = r"^(\d{4}-\d{2}-\d{2}) 00:00:00$"
+
+def fechas_sin_hora(df):
+    """
+    Al leer con dtype=str las celdas de fecha llegan como "AAAA-MM-DD 00:00:00";
+    se deja sólo la fecha, como se mostraban al leerlas como fechas.
+    """
+    for col in df.columns:
+        valores = df[col]
+        if valores.dtype == object or isinstance(valores.dtype, pd.StringDtype):
+            con_hora = valores.str.endswith(" 00:00:00", na=False)
+            if con_hora.any():
+                df.loc[con_hora, col] = valores[con_hora].str.replace(FECHA_CON_HORA_RE, r"\1", regex=True)
+    return df
+
+# cache_resource: una sola copia por proceso compartida por todas las sesiones,
+# sin serializar los DataFrames en cada acierto de caché. Los DataFrames
+# devueltos son de solo lectura: quien necesite modificarlos debe hacer .copy()
+@st.cache_resource(show_spinner=False)
+def load_data():
+    def load_annex(name, filename, skip):
+        # skip: filas antes del encabezado; la fila anterior al encabezado es el fallback
+        df = pd.DataFrame()
+        try:
+            # 1) Caché Parquet, si sigue al día con el XLSX
+            path = os.path.join(RESTRICCIONES_PATH, filename)
+            df_cache = leer_cache_parquet(path)
+            if df_cache is not None:
+                return df_cache, "caché Parquet"
+
+            # 2) Una sola pasada por el libro desde la fila de fallback (la justo
+            #    anterior al header): fila 0 = fallback, fila 1 = header, resto = datos
+            raw = pd.read_excel(BytesIO(leer_bytes(path)), header=None, skiprows=skip-1,
+                                dtype=str, **EXCEL_KWARGS)
+            df = raw.iloc[2:].reset_index(drop=True)
+
+            # 3) Encabezados vacíos: se usa el valor de fallback o, si tampoco hay, "Unnamed: i"
+            df.columns = nombres_de_columnas(raw.iloc[1].tolist(), raw.iloc[0].tolist())
+            df = fechas_sin_hora(df)
+
+            df = guardar_cache_parquet(path, df)
+            return df, "Excel"
+        except Exception as e:
+            return df, f"❌ Error {name}: {e}"
+
+    def load_cas_db():
+        # Cargar base de datos CAS - CORREGIDO
+        info = []
+        cas_db = pd.DataFrame()
+        try:
+            # RUTA CORREGIDA: usar carpeta CAS
+            cas_db_path = os.path.join(CAS_PATH, "COSING_Ingredients-Fragrance Inventory_v2.xlsx")
+            info.append(f"Intentando cargar CAS desde: {cas_db_path}")
+
+            cas_db_cache = leer_cache_parquet(cas_db_path)
+            if cas_db_cache is not None:
+                info.append(f"✅ COSING Ingredients-Fragrance Inventory cargado desde caché Parquet: {len(cas_db_cache)} filas")
+                info.append(f"Columnas en CAS DB: {', '.join(cas_db_cache.columns.tolist())}")
+                return cas_db_cache, info
+            
+            # Una sola lectura del libro; el encabezado se busca entre las primeras
+            # filas: la primera con columnas mayormente con nombre y alguna de nombre/INCI
+            raw = pd.read_excel(BytesIO(leer_bytes(cas_db_path)), header=None,
+                                dtype=str, **EXCEL_KWARGS)
+            cas_db_loaded = False
+            for skip_rows in range(min(CAS_DB_MAX_FILAS_ENCABEZADO, len(raw))):
+                header = [str(v).strip() if pd.notna(v) else "" for v in raw.iloc[skip_rows]]
+                named_columns = [col for col in header if col]
                 
-                # Verificar si tiene datos útiles y columnas reales (no todas "Unnamed")
-                if len(cas_db_temp) > 1000:  # Debe tener muchos registros
-                    # Contar cuántas columnas NO son "Unnamed"
-                    named_columns = [col for col in cas_db_temp.columns if not str(col).lower().startswith("unnamed")]
-                    unnamed_columns = [col for col in cas_db_temp.columns if str(col).lower().startswith("unnamed")]
-                    
-                    # Si tiene más columnas con nombre real que "Unnamed", es buena señal
-                    if len(named_columns) >= len(unnamed_columns):
-                        has_name_col = any('name' in col.lower() or 'inci' in col.lower() or 'ingredient' in col.lower() for col in cas_db_temp.columns)
-                        if has_name_col:
-                            cas_db = cas_db_temp
-                            info_carga.append(f"✅ COSING Ingredients-Fragrance Inventory cargado con skiprows={skip_rows}: {len(cas_db)} filas")
-                            info_carga.append(f"Columnas en CAS DB: {', '.join(cas_db.columns.tolist())}")
-                            
-                            # Renombrar columna si es necesario
-                            if "INCI name" in cas_db.columns:
-                                cas_db.rename(columns={"INCI name": "Ingredient"}, inplace=True)
-                                info_carga.append("✅ Columna 'INCI name' renombrada a 'Ingredient'")
-                            
-                            cas_db_loaded = True
-                            break
-            except Exception as inner_e:
-                continue
-        
-        if not cas_db_loaded:
-            info_carga.append(f"❌ No se pudo cargar la base de datos CAS con ninguna configuración válida")
-        
-    except Exception as e:
-        cas_db = pd.DataFrame(columns=['Ingredient', 'CAS Number'])
-        info_carga.append(f"❌ Error cargando COSING Ingredients-Fragrance Inventory: {e}")
+                # Más columnas con nombre real que vacías ("Unnamed") y alguna de ingredientes
+                if len(named_columns) < 3 or len(named_columns) < len(header) - len(named_columns):
+                    continue
+                if not any('name' in col.lower() or 'inci' in col.lower() or 'ingredient' in col.lower() for col in named_columns):
+                    continue
+                
+                cas_db_temp = raw.iloc[skip_rows + 1:].reset_index(drop=True)
+                # Mismos nombres que con header=0, repetidos incluidos ("X.1")
+                cas_db_temp.columns = nombres_de_columnas(header)
+                if len(cas_db_temp) <= 1000:  # Debe tener muchos registros
+                    continue
+                
+                cas_db = cas_db_temp
+                info.append(f"✅ COSING Ingredients-Fragrance Inventory cargado con skiprows={skip_rows}: {len(cas_db)} filas")
+                
+                # Renombrar columna si es necesario
+                if "INCI name" in cas_db.columns:
+                    # Si ya hubiera una columna "Ingredient", la segunda de las dos pasa a "Ingredient.1"
+                    cas_db.columns = deduplicar_nombres(
+                        ["Ingredient" if col == "INCI name" else col for col in cas_db.columns])
+                    info.append("✅ Columna 'INCI name' renombrada a 'Ingredient'")
+                # Tras el renombrado, para que coincida con la línea de la caché
+                info.append(f"Columnas en CAS DB: {', '.join(cas_db.columns.tolist())}")
+                
+                cas_db = guardar_cache_parquet(cas_db_path, fechas_sin_hora(cas_db))
+                cas_db_loaded = True
+                break
+            
+            if not cas_db_loaded:
+                info.append(f"❌ No se pudo cargar la base de datos CAS con ninguna configuración válida")
+            
+        except Exception as e:
+            cas_db = pd.DataFrame(columns=['Ingredient', 'CAS Number'])
+            info.append(f"❌ Error cargando COSING Ingredients-Fragrance Inventory: {e}")
+
+        return cas_db, info
+
+    # Los siete libros son independientes: se leen en paralelo y el tiempo
+    # total queda acotado por el archivo más lento (la base CAS)
+    with ThreadPoolExecutor(max_workers=len(ANEXOS) + 1) as executor:
+        futuros = {
+            executor.submit(load_annex, nombre, filename, skip): nombre
+            for nombre, (filename, skip) in ANEXOS.items()
+        }
+        futuros[executor.submit(load_cas_db)] = "CAS DB"
+        cargados = {}
+        for futuro in as_completed(futuros):
+            cargados[futuros[futuro]] = futuro.result()
+
+    # Ensamblar en orden fijo, independiente del orden de llegada.
+    # origen_carga: de dónde salió cada tabla (o el error), para load_info
+    origen_carga = {nombre: cargados[nombre][1] for nombre in ORDEN_CARGA}
+    # Texto respaldado por Arrow: los .str de las búsquedas corren en kernels C++
+    annex_data = {nombre: texto_a_arrow(cargados[nombre][0]) for nombre in ANEXOS}
+    cas_db = texto_a_arrow(cargados["CAS DB"][0])
+
+    return annex_data, cas_db, origen_carga
+
+@st.cache_data(show_spinner=False)
+def load_info():
+    """
+    Arma las líneas de diagnóstico de la carga. Sólo se llama cuando el usuario
+    pide verlas, así que no forma parte de los datos cacheados por load_data.
+    """
+    annex_data, cas_db, origen_carga = load_data()
+    tablas = {**annex_data, "CAS DB": cas_db}
+    info_carga = []
+    for nombre, df in tablas.items():
+        origen = origen_carga[nombre]
+        if nombre == "CAS DB":
+            # La base CAS ya trae su propio detalle (ruta, skiprows, columnas)
+            info_carga.extend(origen)
+        elif origen.startswith("❌"):
+            info_carga.append(origen)
+        elif origen == "caché Parquet":
+            info_carga.append(f"✅ {nombre}: {len(df)} filas (caché Parquet)")
+        else:
+            info_carga.append(f"✅ {nombre}: {len(df)} filas")
+    return info_carga
 
-    return annex_ii, annex_iii, annex_iv, annex_v, annex_vi, mercosur, cas_db, info_carga
 # -----------------------------------------------------------
-# FUNCIÓN PARA BÚSQUEDA EN PUBCHEM POR CAS
+# ÍNDICES DE BÚSQUEDA (se construyen una sola vez por proceso)
 # -----------------------------------------------------------
-def buscar_cas_en_pubchem(cas_number):
+# Separadores habituales cuando una celda trae varios CAS ("50-00-0 / 64-17-5"); los
+# espacios no separan, para no indexar cada palabra de las celdas con texto libre
+CAS_SEPARADORES_RE = re.compile(r"[;,/\n\r]+")
+# Números con forma de CAS dentro de una celda, aunque lleven notas ("548-62-9[1]")
+# o espacios sueltos junto a los guiones ("72623- 86-0")
+CAS_EN_CELDA_RE = re.compile(r"(?<![\d-])\d{2,7} *- *\d{2} *- *\d(?![\d-])")
+# Un CAS queda determinado por sus dígitos: "51-84-3", "51843" y "51 84 3" son el mismo
+CAS_NO_DIGITOS_RE = re.compile(r"\D")
+# Formato canónico de un número CAS: 2-7 dígitos, 2 dígitos y el dígito de control
+# (sólo dígitos ASCII: "²" o "٢" no son un CAS)
+CAS_FORMATO_RE = re.compile(r"^[0-9]{2,7}-[0-9]{2}-[0-9]$")
+
+def cas_valido(cas):
     """
-    Busca un número CAS en PubChem y devuelve información relevante.
+    Comprueba el formato de un número CAS (con guiones o sólo dígitos) y su dígito
+    de control: la suma de los demás dígitos, de derecha a izquierda, multiplicados
+    por 1, 2, 3... módulo 10.
+    """
+    cas = cas.strip()
+    if CAS_FORMATO_RE.match(cas):
+        digitos = cas.replace("-", "")
+    elif cas.isascii() and cas.isdecimal() and 5 <= len(cas) <= 10:
+        digitos = cas
+    else:
+        return False
+    control = sum(i * int(d) for i, d in enumerate(reversed(digitos[:-1]), 1)) % 10
+    return control == int(digitos[-1])
+
+def tokens_cas(valor):
+    """
+    Números con forma de CAS de una celda: los que llevan guiones (aunque estén
+    rodeados de texto) y los fragmentos de 5 a 10 dígitos sin guiones.
     """
+    tokens = set(CAS_EN_CELDA_RE.findall(valor))
+    for parte in CAS_SEPARADORES_RE.split(valor):
+        parte = parte.strip()
+        if parte.isdigit() and 5 <= len(parte) <= 10:
+            tokens.add(parte)
+    return tokens
+
+def detectar_columna_nombre(df):
+    """
+    Devuelve la primera columna que parezca contener nombres de ingredientes, o None.
+    """
+    for col in df.columns:
+        col_lower = str(col).lower()
+        if any(keyword in col_lower for keyword in ['name', 'ingredient', 'inci', 'substance']):
+            return col
+    return None
+
+@st.cache_resource(show_spinner=False)
+def build_indexes(_annex_data, _cas_db):
+    """
+    Precalcula las estructuras que usan las búsquedas para no recorrer los
+    DataFrames completos en cada consulta:
+    - "cas": {cas: {anexo: posiciones de fila (np.int32)}} sobre todas las columnas
+      CAS de todos los anexos, así cada CAS buscado es una sola consulta
+    - "cas_digitos": igual que "cas" pero con la clave reducida a sus dígitos
+    - "nombres": {anexo: columna "Name" en minúsculas}
+    - "cas_db_nombre": columna de nombre de la base CAS en minúsculas y sin espacios
+    - "cas_db_filas_por_nombre": {nombre normalizado: etiquetas de fila} de la base CAS
+    - "cas_db_columna_nombre" / "cas_db_columna_cas": columnas de nombre y de número
+      CAS de la base CAS (o None)
+    Los DataFrames recibidos no se modifican.
+    """
+    indice_cas = {}
+    indice_digitos = {}
+    nombres = {}
+    for nombre_annex, df_annex in _annex_data.items():
+        if df_annex.empty:
+            continue
+
+        filas_por_cas = {}
+        filas_por_digitos = {}
+        cas_columns = [col for col in df_annex.columns if 'cas' in str(col).lower()]
+        for cas_column in cas_columns:
+            valores = df_annex[cas_column].fillna("").str.strip()
+            for pos, valor in enumerate(valores):
+                if not valor:
+                    continue
+                # La celda completa y cada CAS individual que contenga (no cada palabra)
+                cas_celda = tokens_cas(valor)
+                for token in {valor, *cas_celda}:
+                    filas_por_cas.setdefault(token, set()).add(pos)
+                # Sólo los tokens con forma de CAS entran en el índice de dígitos: notas
+                # como "[1]" o números sueltos del texto no deben dar coincidencias
+                for token in cas_celda:
+                    filas_por_digitos.setdefault(CAS_NO_DIGITOS_RE.sub("", token), set()).add(pos)
+        # Arrays contiguos de posiciones: compactos y directos para df.iloc
+        for cas, pos in filas_por_cas.items():
+            indice_cas.setdefault(cas, {})[nombre_annex] = np.array(sorted(pos), dtype=np.int32)
+        for cas, pos in filas_por_digitos.items():
+            indice_digitos.setdefault(cas, {})[nombre_annex] = np.array(sorted(pos), dtype=np.int32)
+
+        if "Name" in df_annex.columns:
+            nombres[nombre_annex] = df_annex["Name"].str.lower()
+
+    columna_nombre = detectar_columna_nombre(_cas_db) if not _cas_db.empty else None
+    cas_db_nombre = None
+    filas_por_nombre = {}
+    if columna_nombre is not None:
+        cas_db_nombre = _cas_db[columna_nombre].str.lower().str.strip()
+        grupos = cas_db_nombre.groupby(cas_db_nombre, sort=False).groups
+        filas_por_nombre = {nombre: filas.to_numpy() for nombre, filas in grupos.items()}
+
+    columna_cas = next(
+        (col for col in _cas_db.columns if 'cas' in col.lower() and 'no' in col.lower()),
+        None
+    )
+
+    return {
+        "cas": indice_cas,
+        "cas_digitos": indice_digitos,
+        "nombres": nombres,
+        "cas_db_nombre": cas_db_nombre,
+        "cas_db_filas_por_nombre": filas_por_nombre,
+        "cas_db_columna_nombre": columna_nombre,
+        "cas_db_columna_cas": columna_cas,
+    }
+
+# pyahocorasick es opcional: con listas largas de ingredientes encuentra todas las
+# subcadenas de cada nombre en una sola pasada, sin depender del número de patrones
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Por debajo de este número de ingredientes la alternancia de regex resulta más rápida
+AHO_CORASICK_MIN_PATRONES = 50
+
+def filas_por_subcadena(nombres, claves):
+    """
+    Devuelve {clave: [etiquetas de fila]} con las filas cuyo nombre (ya en minúsculas)
+    contiene cada clave, en el orden de la serie.
+    """
+    filas = {clave: [] for clave in claves}
+    if not filas:
+        return filas
+    
+    if ahocorasick is not None and len(filas) >= AHO_CORASICK_MIN_PATRONES and "" not in filas:
+        automata = ahocorasick.Automaton()
+        for clave in filas:
+            automata.add_word(clave, clave)
+        automata.make_automaton()
+        for fila, nombre in zip(nombres.index, nombres):
+            if isinstance(nombre, str):
+                # Una clave puede aparecer varias veces en el mismo nombre
+                for clave in {clave for _, clave in automata.iter(nombre)}:
+                    filas[clave].append(fila)
+        return filas
+    
+    # Una única pasada con todas las claves alternadas deja sólo las filas candidatas;
+    # cada clave se resuelve luego en Python sobre ellas
+    patron = "|".join(re.escape(clave) for clave in filas)
+    candidatos = nombres[nombres.str.contains(patron, na=False, regex=True)]
+    for clave, filas_clave in filas.items():
+        filas_clave.extend(fila for fila, nombre in candidatos.items() if clave in nombre)
+    return filas
+# -----------------------------------------------------------
+# ACCESO HTTP A PUBCHEM
+# -----------------------------------------------------------
+# orjson es opcional: si está instalado decodifica las respuestas bastante más rápido
+try:
+    import orjson
+    decodificar_json = orjson.loads
+except ImportError:
+    decodificar_json = json.loads
+
+# PubChem admite como máximo 5 peticiones por segundo por usuario
+PUBCHEM_MAX_CONCURRENCIA = 5
+# Respuestas que indican saturación o caída temporal del servicio
+PUBCHEM_ESTADOS_TRANSITORIOS = {429, 500, 502, 503, 504}
+# Máximo de consultas distintas guardadas en la caché de disco
+PUBCHEM_CACHE_MAX = 5000
+PUBCHEM_INTERVALO_MIN = 1.0 / PUBCHEM_MAX_CONCURRENCIA
+# Tiempo máximo (s) para conectar y para recibir la respuesta de PubChem
+PUBCHEM_TIMEOUT = (3.05, 10)
+_pubchem_lock = threading.Lock()
+_pubchem_ultima_peticion = [0.0]
+
+# Propiedades que se piden a PubChem para cada compuesto
+PUBCHEM_PROPIEDADES = "MolecularFormula,MolecularWeight,IUPACName,InChIKey,CanonicalSMILES"
+
+# Vigencia (s) de las respuestas de PubChem guardadas en Redis
+PUBCHEM_REDIS_TTL = 7 * 24 * 3600
+# Vigencia (s) de un "no encontrado": no va a la caché de disco (que ignora el ttl),
+# así un compuesto que PubChem añada más tarde aparece sin forzar la consulta
+PUBCHEM_NO_ENCONTRADO_TTL = 24 * 3600
+
+# Patrones como "CAS-xxxxx" o "xxxxx-xx-x" (formato CAS común) dentro de un sinónimo
+CAS_EN_SINONIMO_RE = re.compile(r'(?:CAS[ -]+)?(\d{1,7}-\d{2}-\d{1})')
+
+@st.cache_resource(show_spinner=False)
+def get_pubchem_session():
+    """
+    Sesión HTTP compartida por todos los hilos y sesiones de la app: reutiliza las
+    conexiones TLS con PubChem (keep-alive) y reintenta con backoff exponencial
+    las respuestas transitorias.
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=sorted(PUBCHEM_ESTADOS_TRANSITORIOS),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+def pubchem_get(url):
+    """
+    GET a PubChem que espacia las peticiones de todos los hilos para
+    respetar el límite de la API.
+    """
+    with _pubchem_lock:
+        espera = _pubchem_ultima_peticion[0] + PUBCHEM_INTERVALO_MIN - time.monotonic()
+        if espera > 0:
+            time.sleep(espera)
+        _pubchem_ultima_peticion[0] = time.monotonic()
+    response = get_pubchem_session().get(url, timeout=PUBCHEM_TIMEOUT)
+    # Si tras los reintentos sigue el error transitorio, se eleva para que no se guarden en la caché
+    if response.status_code in PUBCHEM_ESTADOS_TRANSITORIOS:
+        response.raise_for_status()
+    return response
+
+@st.cache_resource(show_spinner=False)
+def get_redis():
+    """
+    Cliente Redis para compartir las respuestas de PubChem entre réplicas y
+    despliegues. Es opcional: devuelve None si no hay REDIS_URL, si falta el
+    paquete redis o si el servidor no responde.
+    """
+    url = os.environ.get("REDIS_URL")
+    if not url:
+        return None
     try:
-        # Primero, buscar el CAS para obtener el CompoundID (CID)
-        search_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{cas_number}/cids/JSON"
-        response = requests.get(search_url)
-        
-        if response.status_code != 200:
-            return {
-                'encontrado': False,
-                'error': f"Error en la búsqueda: Código {response.status_code}",
-                'mensaje': "No se encontró el CAS en PubChem"
-            }
-        
-        data = response.json()
-        
-        if 'IdentifierList' not in data or 'CID' not in data['IdentifierList'] or not data['IdentifierList']['CID']:
-            return {
-                'encontrado': False,
-                'error': "No se encontró un CID válido",
-                'mensaje': "PubChem no tiene registros para este número CAS"
-            }
-        
-        # Obtener el CID
-        cid = data['IdentifierList']['CID'][0]
-        
-        # Obtener información detallada usando el CID
-        info_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/property/MolecularFormula,MolecularWeight,IUPACName,InChIKey,CanonicalSMILES/JSON"
-        info_response = requests.get(info_url)
-        
-        if info_response.status_code != 200:
-            return {
-                'encontrado': True,
-                'cid': cid,
-                'error': f"Error obteniendo detalles: Código {info_response.status_code}",
-                'url': f"https://pubchem.ncbi.nlm.nih.gov/compound/{cid}"
-            }
-        
-        info_data = info_response.json()
-        properties = info_data['PropertyTable']['Properties'][0]
-        
-        # Obtener sinónimos
-        synonyms_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/synonyms/JSON"
-        synonyms_response = requests.get(synonyms_url)
-        
-        synonyms = []
-        if synonyms_response.status_code == 200:
-            synonyms_data = synonyms_response.json()
-            if 'InformationList' in synonyms_data and 'Information' in synonyms_data['InformationList']:
-                synonyms = synonyms_data['InformationList']['Information'][0].get('Synonym', [])
-                # Limitar a máximo 10 sinónimos para no sobrecargar la UI
-                synonyms = synonyms[:10] if len(synonyms) > 10 else synonyms
-        
+        import redis
+        cliente = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        cliente.ping()
+        return cliente
+    except Exception:
+        return None
+
+def normalizar_consulta_pubchem(consulta):
+    """
+    Forma canónica de una consulta (PubChem no distingue mayúsculas ni espacios
+    repetidos): "Glycerin" y " glycerin " comparten la misma entrada de caché.
+    """
+    return " ".join(consulta.split()).lower()
+
+def clave_redis_pubchem(consulta, por_cas):
+    return f"pubchem:{'cas' if por_cas else 'nombre'}:{consulta}"
+
+def con_cache_redis(clave, consultar):
+    """
+    Devuelve la respuesta guardada en Redis bajo la clave o, si no está, la obtiene
+    con consultar() y la guarda. Cualquier fallo de Redis se ignora.
+    """
+    cliente = get_redis()
+    if cliente is not None:
+        try:
+            guardado = cliente.get(clave)
+            if guardado is not None:
+                return decodificar_json(guardado)
+        except Exception:
+            pass
+    
+    resultado = consultar()
+    
+    if cliente is not None:
+        try:
+            ttl = PUBCHEM_REDIS_TTL if resultado.get('encontrado') else PUBCHEM_NO_ENCONTRADO_TTL
+            cliente.setex(clave, ttl, json.dumps(resultado))
+        except Exception:
+            pass
+    return resultado
+
+def borrar_de_redis(clave):
+    cliente = get_redis()
+    if cliente is not None:
+        try:
+            cliente.delete(clave)
+        except Exception:
+            pass
+
+@st.cache_resource(show_spinner=False)
+def get_pubchem_executor():
+    """
+    Pool de hilos compartido para las consultas de sinónimos: se crea una vez por
+    proceso en lugar de un pool por consulta. Es aparte del pool de
+    buscar_lista_en_pubchem, cuyos hilos esperan a estas tareas.
+    """
+    return ThreadPoolExecutor(max_workers=PUBCHEM_MAX_CONCURRENCIA)
+
+def pubchem_propiedades_y_sinonimos(consulta):
+    """
+    Lanza en paralelo las dos consultas encadenadas de PUG REST sobre un nombre o
+    número CAS (propiedades y sinónimos). Ambas respuestas ya traen el CID, así que
+    no hace falta resolverlo antes con una petición aparte.
+    """
+    base_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{consulta}"
+    futuro_sinonimos = get_pubchem_executor().submit(pubchem_get, f"{base_url}/synonyms/JSON")
+    response = pubchem_get(f"{base_url}/property/{PUBCHEM_PROPIEDADES}/JSON")
+    return response, futuro_sinonimos.result()
+
+def extraer_sinonimos(synonyms_response):
+    """
+    Devuelve como máximo 10 sinónimos del primer compuesto de la respuesta.
+    """
+    synonyms = []
+    if synonyms_response.status_code == 200:
+        synonyms_data = decodificar_json(synonyms_response.content)
+        if 'InformationList' in synonyms_data and 'Information' in synonyms_data['InformationList']:
+            synonyms = synonyms_data['InformationList']['Information'][0].get('Synonym', [])
+            # Limitar a máximo 10 sinónimos para no sobrecargar la UI
+            synonyms = synonyms[:10] if len(synonyms) > 10 else synonyms
+    return synonyms
+
+# -----------------------------------------------------------
+# FUNCIÓN PARA BÚSQUEDA EN PUBCHEM POR CAS
+# -----------------------------------------------------------
+def _pedir_cas_a_pubchem(cas_number):
+    """
+    Consulta PubChem por número CAS. Los errores de red no se capturan aquí para
+    que nunca queden guardados en las cachés.
+    """
+    # Propiedades y sinónimos en paralelo, cada respuesta con su CompoundID (CID)
+    response, synonyms_response = pubchem_propiedades_y_sinonimos(cas_number)
+    
+    if response.status_code != 200:
         return {
-            'encontrado': True,
-            'cid': cid,
-            'nombre_iupac': properties.get('IUPACName', 'No disponible'),
-            'formula': properties.get('MolecularFormula', 'No disponible'),
-            'peso_molecular': properties.get('MolecularWeight', 'No disponible'),
-            'inchikey': properties.get('InChIKey', 'No disponible'),
-            'smiles': properties.get('CanonicalSMILES', 'No disponible'),
-            'sinonimos': synonyms,
-            'url': f"https://pubchem.ncbi.nlm.nih.gov/compound/{cid}"
+            'encontrado': False,
+            'error': f"Error en la búsqueda: Código {response.status_code}",
+            'mensaje': "No se encontró el CAS en PubChem"
+        }
+    
+    data = decodificar_json(response.content)
+    properties_list = data.get('PropertyTable', {}).get('Properties', [])
+    
+    if not properties_list or 'CID' not in properties_list[0]:
+        return {
+            'encontrado': False,
+            'error': "No se encontró un CID válido",
+            'mensaje': "PubChem no tiene registros para este número CAS"
         }
     
+    # Obtener el CID y sus propiedades
+    properties = properties_list[0]
+    cid = properties['CID']
+    
+    # Sinónimos (ya descargados junto con las propiedades)
+    synonyms = extraer_sinonimos(synonyms_response)
+    
+    return {
+        'encontrado': True,
+        'cid': cid,
+        'nombre_iupac': properties.get('IUPACName', 'No disponible'),
+        'formula': properties.get('MolecularFormula', 'No disponible'),
+        'peso_molecular': properties.get('MolecularWeight', 'No disponible'),
+        'inchikey': properties.get('InChIKey', 'No disponible'),
+        'smiles': properties.get('CanonicalSMILES', 'No disponible'),
+        'sinonimos': synonyms,
+        'url': f"https://pubchem.ncbi.nlm.nih.gov/compound/{cid}"
+    }
+
+@st.cache_data(show_spinner=False, max_entries=PUBCHEM_CACHE_MAX, ttl=PUBCHEM_NO_ENCONTRADO_TTL)
+def _consultar_cas_reciente(cas_number):
+    """
+    Consulta por CAS cacheada en memoria con caducidad y, si hay Redis
+    configurado, también allí. Guarda también los "no encontrado".
+    """
+    return con_cache_redis(clave_redis_pubchem(cas_number, True),
+                           lambda: _pedir_cas_a_pubchem(cas_number))
+
+@st.cache_data(show_spinner=False, max_entries=PUBCHEM_CACHE_MAX, persist="disk")
+def _consultar_cas_en_pubchem(cas_number):
+    """
+    Consulta por CAS cacheada en disco. Un "no encontrado" se eleva como
+    LookupError para que no se persista: sólo queda en _consultar_cas_reciente.
+    """
+    resultado = _consultar_cas_reciente(cas_number)
+    if not resultado['encontrado']:
+        raise LookupError(resultado['mensaje'])
+    return resultado
+
+def buscar_cas_en_pubchem(cas_number):
+    """
+    Busca un número CAS en PubChem y devuelve información relevante.
+    """
+    consulta = normalizar_consulta_pubchem(cas_number)
+    try:
+        try:
+            return _consultar_cas_en_pubchem(consulta)
+        except LookupError:
+            return _consultar_cas_reciente(consulta)
     except Exception as e:
         return {
             'encontrado': False,
@@ -267,89 +788,92 @@ def buscar_cas_en_pubchem(cas_number):
 # -----------------------------------------------------------
 # FUNCIÓN PARA BÚSQUEDA EN PUBCHEM POR NOMBRE DE INGREDIENTE
 # -----------------------------------------------------------
-def buscar_ingrediente_en_pubchem(nombre_ingrediente):
+def _pedir_ingrediente_a_pubchem(nombre_ingrediente):
     """
-    Busca un ingrediente por nombre en PubChem y devuelve información relevante.
+    Consulta PubChem por nombre de ingrediente. Los errores de red no se capturan
+    aquí para que nunca queden guardados en las cachés.
     """
-    try:
-        # Primero, buscar el nombre para obtener el CompoundID (CID)
-        search_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/{nombre_ingrediente}/cids/JSON"
-        response = requests.get(search_url)
-        
-        if response.status_code != 200:
-            return {
-                'encontrado': False,
-                'error': f"Error en la búsqueda: Código {response.status_code}",
-                'mensaje': f"No se encontró '{nombre_ingrediente}' en PubChem",
-                'input': nombre_ingrediente
-            }
-        
-        data = response.json()
-        
-        if 'IdentifierList' not in data or 'CID' not in data['IdentifierList'] or not data['IdentifierList']['CID']:
-            return {
-                'encontrado': False,
-                'error': "No se encontró un CID válido",
-                'mensaje': f"PubChem no tiene registros para '{nombre_ingrediente}'",
-                'input': nombre_ingrediente
-            }
-        
-        # Obtener el CID
-        cid = data['IdentifierList']['CID'][0]
-        
-        # Obtener información detallada usando el CID
-        info_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/property/MolecularFormula,MolecularWeight,IUPACName,InChIKey,CanonicalSMILES/JSON"
-        info_response = requests.get(info_url)
-        
-        if info_response.status_code != 200:
-            return {
-                'encontrado': True,
-                'cid': cid,
-                'input': nombre_ingrediente,
-                'error': f"Error obteniendo detalles: Código {info_response.status_code}",
-                'url': f"https://pubchem.ncbi.nlm.nih.gov/compound/{cid}"
-            }
-        
-        info_data = info_response.json()
-        properties = info_data['PropertyTable']['Properties'][0]
-        
-        # Obtener sinónimos
-        synonyms_url = f"https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/cid/{cid}/synonyms/JSON"
-        synonyms_response = requests.get(synonyms_url)
-        
-        synonyms = []
-        if synonyms_response.status_code == 200:
-            synonyms_data = synonyms_response.json()
-            if 'InformationList' in synonyms_data and 'Information' in synonyms_data['InformationList']:
-                synonyms = synonyms_data['InformationList']['Information'][0].get('Synonym', [])
-                # Limitar a máximo 10 sinónimos para no sobrecargar la UI
-                synonyms = synonyms[:10] if len(synonyms) > 10 else synonyms
-        
-        # Intentar obtener el número CAS
-        cas_number = None
-        if synonyms:
-            # Buscar patrones como "CAS-xxxxx" o "xxxxx-xx-x" (formato CAS común)
-            cas_pattern = re.compile(r'(?:CAS[ -]+)?(\d{1,7}-\d{2}-\d{1})')
-            for syn in synonyms:
-                cas_match = cas_pattern.search(syn)
-                if cas_match:
-                    cas_number = cas_match.group(1)
-                    break
-        
+    # Propiedades y sinónimos en paralelo, cada respuesta con su CompoundID (CID)
+    response, synonyms_response = pubchem_propiedades_y_sinonimos(nombre_ingrediente)
+    
+    if response.status_code != 200:
+        return {
+            'encontrado': False,
+            'error': f"Error en la búsqueda: Código {response.status_code}",
+            'mensaje': f"No se encontró '{nombre_ingrediente}' en PubChem",
+            'input': nombre_ingrediente
+        }
+    
+    data = decodificar_json(response.content)
+    properties_list = data.get('PropertyTable', {}).get('Properties', [])
+    
+    if not properties_list or 'CID' not in properties_list[0]:
         return {
-            'encontrado': True,
-            'cid': cid,
-            'input': nombre_ingrediente,
-            'nombre_iupac': properties.get('IUPACName', 'No disponible'),
-            'formula': properties.get('MolecularFormula', 'No disponible'),
-            'peso_molecular': properties.get('MolecularWeight', 'No disponible'),
-            'inchikey': properties.get('InChIKey', 'No disponible'),
-            'smiles': properties.get('CanonicalSMILES', 'No disponible'),
-            'sinonimos': synonyms,
-            'cas_number': cas_number,
-            'url': f"https://pubchem.ncbi.nlm.nih.gov/compound/{cid}"
+            'encontrado': False,
+            'error': "No se encontró un CID válido",
+            'mensaje': f"PubChem no tiene registros para '{nombre_ingrediente}'",
+            'input': nombre_ingrediente
         }
     
+    # Obtener el CID y sus propiedades
+    properties = properties_list[0]
+    cid = properties['CID']
+    
+    # Sinónimos (ya descargados junto con las propiedades)
+    synonyms = extraer_sinonimos(synonyms_response)
+    
+    # Intentar obtener el número CAS: una sola búsqueda sobre todos los sinónimos
+    # unidos devuelve el del primer sinónimo que lo contenga
+    cas_match = CAS_EN_SINONIMO_RE.search("\n".join(synonyms))
+    cas_number = cas_match.group(1) if cas_match else None
+    
+    return {
+        'encontrado': True,
+        'cid': cid,
+        'input': nombre_ingrediente,
+        'nombre_iupac': properties.get('IUPACName', 'No disponible'),
+        'formula': properties.get('MolecularFormula', 'No disponible'),
+        'peso_molecular': properties.get('MolecularWeight', 'No disponible'),
+        'inchikey': properties.get('InChIKey', 'No disponible'),
+        'smiles': properties.get('CanonicalSMILES', 'No disponible'),
+        'sinonimos': synonyms,
+        'cas_number': cas_number,
+        'url': f"https://pubchem.ncbi.nlm.nih.gov/compound/{cid}"
+    }
+
+@st.cache_data(show_spinner=False, max_entries=PUBCHEM_CACHE_MAX, ttl=PUBCHEM_NO_ENCONTRADO_TTL)
+def _consultar_ingrediente_reciente(nombre_ingrediente):
+    """
+    Consulta por nombre cacheada en memoria con caducidad y, si hay Redis
+    configurado, también allí. Guarda también los "no encontrado".
+    """
+    return con_cache_redis(clave_redis_pubchem(nombre_ingrediente, False),
+                           lambda: _pedir_ingrediente_a_pubchem(nombre_ingrediente))
+
+@st.cache_data(show_spinner=False, max_entries=PUBCHEM_CACHE_MAX, persist="disk")
+def _consultar_ingrediente_en_pubchem(nombre_ingrediente):
+    """
+    Consulta por nombre cacheada en disco. Un "no encontrado" se eleva como
+    LookupError para que no se persista: sólo queda en _consultar_ingrediente_reciente.
+    """
+    resultado = _consultar_ingrediente_reciente(nombre_ingrediente)
+    if not resultado['encontrado']:
+        raise LookupError(resultado['mensaje'])
+    return resultado
+
+def buscar_ingrediente_en_pubchem(nombre_ingrediente):
+    """
+    Busca un ingrediente por nombre en PubChem y devuelve información relevante.
+    """
+    consulta = normalizar_consulta_pubchem(nombre_ingrediente)
+    try:
+        try:
+            resultado = _consultar_ingrediente_en_pubchem(consulta)
+        except LookupError:
+            resultado = _consultar_ingrediente_reciente(consulta)
+        # Se muestra el nombre tal como lo escribió el usuario
+        resultado['input'] = nombre_ingrediente
+        return resultado
     except Exception as e:
         return {
             'encontrado': False,
@@ -361,86 +885,119 @@ def buscar_ingrediente_en_pubchem(nombre_ingrediente):
 # -----------------------------------------------------------
 # FUNCIÓN PARA BUSCAR MÚLTIPLES ELEMENTOS EN PUBCHEM
 # -----------------------------------------------------------
-def buscar_lista_en_pubchem(lista, por_cas=True):
+def buscar_lista_en_pubchem(lista, por_cas=True, forzar=False):
     """
-    Busca múltiples números CAS o nombres de ingredientes en PubChem con un retraso para evitar sobrecargar la API.
+    Busca múltiples números CAS o nombres de ingredientes en PubChem en paralelo.
+    El ritmo global de peticiones lo controla pubchem_get para no sobrecargar la API.
+    Con forzar=True se descartan las respuestas cacheadas de estos elementos.
     """
-    resultados = {}
+    buscar = buscar_cas_en_pubchem if por_cas else buscar_ingrediente_en_pubchem
+    tipo = "CAS" if por_cas else "ingredientes"
     
-    for i, elemento in enumerate(lista):
-        if i > 0:  # Añadir delay entre peticiones excepto para la primera
-            time.sleep(1)  # 1 segundo de retraso para respetar límites de la API
-        
-        if por_cas:
-            mensaje = f"Buscando CAS {elemento} en PubChem..."
-            resultado = buscar_cas_en_pubchem(elemento)
-        else:
-            mensaje = f"Buscando ingrediente '{elemento}' en PubChem..."
-            resultado = buscar_ingrediente_en_pubchem(elemento)
-        
-        with st.spinner(mensaje):
-            resultados[elemento] = resultado
+    if forzar:
+        consultar = _consultar_cas_en_pubchem if por_cas else _consultar_ingrediente_en_pubchem
+        reciente = _consultar_cas_reciente if por_cas else _consultar_ingrediente_reciente
+        for item in lista:
+            consulta = normalizar_consulta_pubchem(item)
+            consultar.clear(consulta)
+            reciente.clear(consulta)
+            borrar_de_redis(clave_redis_pubchem(consulta, por_cas))
     
-    return resultados
+    resultados = {}
+    with st.status(f"Buscando {len(lista)} {tipo} en PubChem...", expanded=True) as status:
+        with ThreadPoolExecutor(max_workers=PUBCHEM_MAX_CONCURRENCIA) as executor:
+            futuros = {executor.submit(buscar, item): item for item in lista}
+            # Las respuestas se informan desde este hilo a medida que llegan
+            for i, futuro in enumerate(as_completed(futuros), 1):
+                item = futuros[futuro]
+                resultados[item] = futuro.result()
+                marca = "✔" if resultados[item]['encontrado'] else "✘"
+                status.write(f"{marca} {item} ({i}/{len(lista)})")
+        status.update(label=f"Consulta a PubChem terminada: {len(lista)} {tipo}",
+                      state="complete", expanded=False)
+    
+    # Mantener el orden de entrada
+    return {item: resultados[item] for item in lista}
 
 # -----------------------------------------------------------
 # FUNCIÓN PARA BUSCAR CAS EN RESTRICCIONES
 # -----------------------------------------------------------
-def buscar_cas_en_restricciones(cas_list, mostrar_info=False):
+# Máximo de listas de CAS distintas guardadas en la caché de búsqueda: la clave
+# es lo que escribe el usuario, así que sin límite crecería toda la vida del proceso
+BUSQUEDA_CAS_CACHE_MAX = 1000
+
+@st.cache_data(show_spinner=False, max_entries=BUSQUEDA_CAS_CACHE_MAX)
+def _buscar_cas_en_anexos(cas_list, _indices, _annex_data):
+    """
+    Busca cada CAS en los índices de los anexos, sin llamadas a Streamlit, así que
+    se puede cachear. Índices y anexos se reciben como argumentos (con "_" para que
+    Streamlit no los hashee): la clave de caché es sólo la lista de CAS, válida
+    porque los datos se cargan una única vez por proceso.
+    """
     resultados = {}
     
     for cas_number in cas_list:
         resultados[cas_number] = {"encontrado": False, "anexos": []}
         
-        if mostrar_info:
-            st.markdown(f"### Buscando CAS: {cas_number}")
-        
-        # Búsqueda EXACTA en todos los anexos
-        if mostrar_info:
-            st.write(f"Buscando {cas_number} con coincidencia EXACTA...")
+        cas_buscado = cas_number.strip()
+        cas_digitos = CAS_NO_DIGITOS_RE.sub("", cas_buscado)
         
-        encontrado_en_alguno = False
+        # Una consulta al índice global por CAS: {anexo: filas}
+        exactos = _indices["cas"].get(cas_buscado, {})
+        # El índice de dígitos sólo se consulta con consultas que puedan ser un CAS
+        # (un CAS tiene al menos 5 dígitos), no con "1" o "abc-1"
+        normalizados = {}
+        if len(cas_digitos) >= 5:
+            normalizados = _indices["cas_digitos"].get(cas_digitos, {})
         
-        for nombre_annex, df_annex in annex_data.items():
-            if df_annex.empty:
-                continue
+        for nombre_annex, df_annex in _annex_data.items():
+            # BÚSQUEDA EXACTA en el anexo
+            filas = exactos.get(nombre_annex)
+            tipo = "coincidencia exacta"
             
-            # Buscar columnas CAS
-            cas_columns = [col for col in df_annex.columns if 'cas' in col.lower()]
+            # Si falla, se usa el CAS normalizado (sólo dígitos) en ambos lados
+            if filas is None:
+                filas = normalizados.get(nombre_annex)
+                tipo = "CAS normalizado"
             
-            if not cas_columns:
+            if filas is None:
                 continue
             
-            for cas_column in cas_columns:
-                if mostrar_info:
-                    st.write(f"Buscando en {nombre_annex}, columna '{cas_column}'...")
-                
-                # BÚSQUEDA EXACTA: Convertir a string, limpiar espacios y comparar exactamente
-                matches = df_annex[df_annex[cas_column].astype(str).str.strip() == cas_number.strip()]
-                
-                if not matches.empty:
-                    if mostrar_info:
-                        st.success(f"✅ ENCONTRADO en {nombre_annex}, columna '{cas_column}' (coincidencia exacta)")
-                        st.dataframe(matches)
-                    
-                    resultados[cas_number]["encontrado"] = True
-                    resultados[cas_number]["anexos"].append({
-                        "nombre": nombre_annex,
-                        "data": matches
-                    })
-                    encontrado_en_alguno = True
-                    break
-            
-            # Si ya lo encontramos en este anexo, pasamos al siguiente
-            if encontrado_en_alguno:
-                break
+            # Se sigue con los demás anexos: un CAS puede estar en varios
+            resultados[cas_number]["encontrado"] = True
+            resultados[cas_number]["anexos"].append({
+                "nombre": nombre_annex,
+                "data": df_annex.iloc[filas],
+                "tipo": tipo
+            })
+    
+    return resultados
+
+def mostrar_detalle_busqueda_cas(resultados):
+    """
+    Muestra, CAS por CAS, en qué anexos se encontró y con qué tipo de coincidencia.
+    """
+    for cas_number, res in resultados.items():
+        st.markdown(f"### Buscando CAS: {cas_number}")
+        st.write(f"Buscando {cas_number} con coincidencia EXACTA...")
+        
+        for anexo in res["anexos"]:
+            st.success(f"✅ ENCONTRADO en {anexo['nombre']} ({anexo['tipo']})")
+            st.dataframe(anexo["data"])
         
-        if not encontrado_en_alguno and mostrar_info:
+        if not res["encontrado"]:
             st.warning(f"❌ No se encontró el CAS {cas_number} en ningún anexo (búsqueda exacta)")
         
-        if mostrar_info:
-            st.markdown("---")  # Separador entre resultados de CAS
-    
+        st.markdown("---")  # Separador entre resultados de CAS
+
+def buscar_cas_en_restricciones(cas_list, mostrar_info=False):
+    """
+    Busca los CAS en todos los anexos; con mostrar_info se muestra además el detalle
+    de la búsqueda, una vez terminada y fuera del bucle de cálculo.
+    """
+    resultados = _buscar_cas_en_anexos(list(cas_list), indices, annex_data)
+    if mostrar_info:
+        mostrar_detalle_busqueda_cas(resultados)
     return resultados
 
 # -----------------------------------------------------------
@@ -454,71 +1011,47 @@ def buscar_ingredientes_por_nombre(ingredientes, exact=False):
         st.error("La base de datos CAS está vacía o no se cargó correctamente.")
         return pd.DataFrame()
     
-    # Detectar automáticamente las posibles columnas de nombre
-    posibles_columnas_nombre = []
-    for col in cas_db.columns:
-        col_lower = col.lower()
-        if any(keyword in col_lower for keyword in ['name', 'ingredient', 'inci', 'substance']):
-            posibles_columnas_nombre.append(col)
+    # Columna de nombre detectada una sola vez en build_indexes (la primera que coincida)
+    columna_nombre = indices["cas_db_columna_nombre"]
     
-    if not posibles_columnas_nombre:
+    if columna_nombre is None:
         st.error("No se encontraron columnas que contengan nombres de ingredientes.")
         st.write("Las columnas disponibles son:", cas_db.columns.tolist())
         return pd.DataFrame()
     
-    # Usar la primera columna detectada como columna principal
-    columna_nombre = posibles_columnas_nombre[0]
+    # Nombres ya normalizados (minúsculas, sin espacios) en build_indexes
+    nombres = indices["cas_db_nombre"]
     
-    # Detectar columna de CAS
-    columna_cas = None
-    for col in cas_db.columns:
-        if 'cas' in col.lower() and 'no' in col.lower():
-            columna_cas = col
-            break
+    # Columna de CAS detectada una sola vez en build_indexes
+    columna_cas = indices["cas_db_columna_cas"]
     
-    # Buscar cada ingrediente según el modo (exacto o aproximado)
-    for ing in ingredientes:
-        # Limpiar el ingrediente de búsqueda
-        ing_limpio = ing.strip()
+    # Ingredientes normalizados igual que los nombres de la base
+    claves = [ing.strip().lower() for ing in ingredientes]
+    
+    if exact:
+        # Modo exacto: consulta directa al índice nombre -> filas, sin recorrer la base
+        filas_por_clave = indices["cas_db_filas_por_nombre"]
+    else:
+        # Modo aproximado: coincidencias parciales de todos los ingredientes a la vez
+        filas_por_clave = filas_por_subcadena(nombres, claves)
+    
+    # Un bloque por ingrediente, en el orden de la fórmula
+    for ing, clave in zip(ingredientes, claves):
+        # Exacto: mismo nombre ignorando mayúsculas y espacios adicionales
+        filas = filas_por_clave.get(clave, [])
         
-        if exact:
-            # Comparación exacta (ignorando mayúsculas y espacios adicionales)
-            mask = cas_db[columna_nombre].astype(str).str.lower().str.strip() == ing_limpio.lower()
-            df_ing = cas_db[mask]
-            
-            if df_ing.empty:
-                # Si no se encuentra, crear una fila indicando "No encontrado"
-                df_not_found = pd.DataFrame({
-                    "Búsqueda": [ing],
-                    columna_nombre: [ing],
-                    "Resultado": ["No encontrado (exacto)"]
-                })
-                if columna_cas:
-                    df_not_found[columna_cas] = [None]
-                resultados_formula.append(df_not_found)
-            else:
-                df_ing = df_ing.copy()
-                df_ing["Búsqueda"] = ing
-                resultados_formula.append(df_ing)
+        if len(filas):
+            resultados_formula.append(cas_db.loc[filas].assign(Búsqueda=ing))
         else:
-            # Búsqueda aproximada: se buscan coincidencias parciales
-            mask = cas_db[columna_nombre].astype(str).str.contains(ing_limpio, case=False, na=False, regex=False)
-            df_ing = cas_db[mask]
-            
-            if not df_ing.empty:
-                df_ing = df_ing.copy()
-                df_ing["Búsqueda"] = ing
-                resultados_formula.append(df_ing)
-            else:
-                # También crear una fila "No encontrado" en modo aproximado
-                df_not_found = pd.DataFrame({
-                    "Búsqueda": [ing],
-                    columna_nombre: [ing],
-                    "Resultado": ["No encontrado (aproximado)"]
-                })
-                if columna_cas:
-                    df_not_found[columna_cas] = [None]
-                resultados_formula.append(df_not_found)
+            # Si no se encuentra, crear una fila indicando "No encontrado"
+            df_not_found = pd.DataFrame({
+                "Búsqueda": [ing],
+                columna_nombre: [ing],
+                "Resultado": ["No encontrado (exacto)" if exact else "No encontrado (aproximado)"]
+            })
+            if columna_cas:
+                df_not_found[columna_cas] = [None]
+            resultados_formula.append(df_not_found)
     
     if resultados_formula:
         resultado_final = pd.concat(resultados_formula, ignore_index=True)
@@ -526,71 +1059,6 @@ def buscar_ingredientes_por_nombre(ingredientes, exact=False):
     else:
         return pd.DataFrame()
 
-# -----------------------------------------------------------
-# FUNCIÓN PARA BUSCAR MÚLTIPLES CAS EN PUBCHEM
-# -----------------------------------------------------------
-def buscar_cas_faltantes_en_pubchem(ingredientes_sin_cas):
-    """
-    Busca números CAS en PubChem para ingredientes que no los tienen en la base local
-    """
-    st.info(f"🔍 Buscando números CAS en PubChem para {len(ingredientes_sin_cas)} ingredientes...")
-    
-    resultados_pubchem = {}
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    for i, ingrediente in enumerate(ingredientes_sin_cas):
-        # Actualizar progreso
-        progress = (i + 1) / len(ingredientes_sin_cas)
-        progress_bar.progress(progress)
-        status_text.text(f"Buscando: {ingrediente} ({i+1}/{len(ingredientes_sin_cas)})")
-        
-        # Buscar en PubChem
-        resultado = buscar_ingrediente_en_pubchem(ingrediente)
-        resultados_pubchem[ingrediente] = resultado
-        
-        # Delay para no sobrecargar la API
-        if i < len(ingredientes_sin_cas) - 1:
-            time.sleep(1)
-    
-    progress_bar.empty()
-    status_text.empty()
-    
-    # Procesar resultados
-    cas_encontrados = {}
-    ingredientes_sin_exito = []
-    
-    for ingrediente, resultado in resultados_pubchem.items():
-        if resultado['encontrado'] and 'cas_number' in resultado and resultado['cas_number']:
-            cas_encontrados[ingrediente] = resultado['cas_number']
-        else:
-            ingredientes_sin_exito.append(ingrediente)
-    
-    # Mostrar resultados
-    if cas_encontrados:
-        st.success(f"✅ Se encontraron números CAS para {len(cas_encontrados)} ingredientes en PubChem:")
-        
-        # Crear DataFrame con los resultados
-        df_pubchem = pd.DataFrame([
-            {
-                "Ingrediente": ing,
-                "CAS Number": cas,
-                "Fuente": "PubChem"
-            }
-            for ing, cas in cas_encontrados.items()
-        ])
-        
-        st.dataframe(df_pubchem)
-        
-        # Guardar en session_state para usar después
-        st.session_state["cas_from_pubchem"] = df_pubchem
-    
-    if ingredientes_sin_exito:
-        st.warning(f"⚠️ No se encontraron números CAS para {len(ingredientes_sin_exito)} ingredientes:")
-        st.write(", ".join(ingredientes_sin_exito))
-    
-    return cas_encontrados
-
 # -----------------------------------------------------------
 # FUNCIÓN PARA VALIDAR Y FILTRAR CAS VÁLIDOS
 # -----------------------------------------------------------
@@ -623,21 +1091,28 @@ def validar_y_filtrar_cas(df_editado, cas_column):
 # -----------------------------------------------------------
 def buscar_ingredientes_en_anexos(ingredientes):
     resultados_anexos = {}
+    if not ingredientes:
+        return resultados_anexos
+    
+    ingredientes_lower = [ing.lower() for ing in ingredientes]
     
     for nombre_annex, df_annex in annex_data.items():
-        if df_annex.empty or "Name" not in df_annex.columns:
+        nombres = indices["nombres"].get(nombre_annex)
+        if nombres is None:
             continue
         
-        resultados_annex = pd.DataFrame()
-        for ing in ingredientes:
-            res = df_annex[df_annex["Name"].astype(str).str.contains(ing, case=False, na=False)]
-            if not res.empty:
-                res = res.copy()
-                res["Búsqueda"] = ing
-                resultados_annex = pd.concat([resultados_annex, res], ignore_index=True)
+        # Una fila que contiene varios ingredientes aparece una vez por cada uno
+        filas_por_clave = filas_por_subcadena(nombres, ingredientes_lower)
+        filas, busquedas = [], []
+        for ing, ing_lower in zip(ingredientes, ingredientes_lower):
+            filas_ing = filas_por_clave[ing_lower]
+            filas.extend(filas_ing)
+            busquedas.extend([ing] * len(filas_ing))
         
-        if not resultados_annex.empty:
-            resultados_anexos[nombre_annex] = resultados_annex
+        if filas:
+            resultados_anexos[nombre_annex] = (
+                df_annex.loc[filas].assign(Búsqueda=busquedas).reset_index(drop=True)
+            )
     
     return resultados_anexos
 
@@ -674,8 +1149,8 @@ def mostrar_info_pubchem(pubchem_data):
         # Sinónimos
         if 'sinonimos' in pubchem_data and pubchem_data['sinonimos']:
             with st.expander("Ver sinónimos"):
-                for sinonimo in pubchem_data['sinonimos']:
-                    st.write(f"• {sinonimo}")
+                # Un solo elemento con todos los sinónimos en lugar de uno por línea
+                st.markdown("\n".join(f"- {sinonimo}" for sinonimo in pubchem_data['sinonimos']))
         
         # Enlace a PubChem
         st.markdown(f"[Ver ficha completa en PubChem]({pubchem_data['url']})")
@@ -686,22 +1161,78 @@ def mostrar_info_pubchem(pubchem_data):
         if 'error' in pubchem_data:
             st.write("Error:", pubchem_data['error'])
 
+# -----------------------------------------------------------
+# FUNCIÓN PARA MOSTRAR RESULTADOS EN RESTRICCIONES
+# -----------------------------------------------------------
+# Hasta este número de CAS encontrados se muestra un desplegable por CAS;
+# con más, una única tabla con todos
+MAX_RESULTADOS_ABIERTOS = 5
+
+def mostrar_resultados_restricciones(resultados):
+    """
+    Muestra un desplegable por CAS con las filas de todos los anexos donde aparece
+    en una sola tabla (columna "Anexo"), en lugar de una tabla por anexo. Con muchos
+    CAS encontrados se muestra una única tabla con columnas "CAS" y "Anexo".
+    """
+    # Una sola pasada separa los CAS encontrados de los no encontrados
+    encontrados, no_encontrados = {}, []
+    for cas_n, res in resultados.items():
+        if res["encontrado"]:
+            encontrados[cas_n] = res
+        else:
+            no_encontrados.append(cas_n)
+    
+    if len(encontrados) > MAX_RESULTADOS_ABIERTOS:
+        # Un solo mensaje al navegador: el contenido de un desplegable se envía
+        # aunque esté cerrado, así que N desplegables no ahorran nada
+        df_todos = pd.concat(
+            [anexo["data"].assign(CAS=cas_n, Anexo=anexo["nombre"])
+             for cas_n, res in encontrados.items() for anexo in res["anexos"]],
+            ignore_index=True
+        )
+        df_todos = df_todos[["CAS", "Anexo"] + [c for c in df_todos.columns if c not in ("CAS", "Anexo")]]
+        st.write(f"**{len(encontrados)} CAS encontrados** en los anexos:")
+        st.dataframe(df_todos)
+    else:
+        for cas_n, res in encontrados.items():
+            df_cas = pd.concat(
+                [anexo["data"].assign(Anexo=anexo["nombre"]) for anexo in res["anexos"]],
+                ignore_index=True
+            )
+            df_cas = df_cas[["Anexo"] + [c for c in df_cas.columns if c != "Anexo"]]
+            n_anexos = len(res["anexos"])
+            etiqueta = f"CAS {cas_n} — {n_anexos} {'anexo' if n_anexos == 1 else 'anexos'}"
+            with st.expander(etiqueta, expanded=True):
+                st.dataframe(df_cas)
+    
+    # Un único aviso con la lista en texto plano (sin markdown, con botón de copiar)
+    if no_encontrados:
+        st.warning(f"⚠️ {len(no_encontrados)} CAS no encontrados en ningún anexo:")
+        st.code("\n".join(no_encontrados), language=None)
+
 # -----------------------------------------------------------
 # CARGA DE DATOS
 # -----------------------------------------------------------
-annex_ii, annex_iii, annex_iv, annex_v, annex_vi, mercosur, cas_db, info_carga = load_data()
-annex_data = {
-    "Annex II": annex_ii,
-    "Annex III": annex_iii,
-    "Annex IV": annex_iv,
-    "Annex V": annex_v,
-    "Annex VI": annex_vi,
-    "MERCOSUR Prohibidas": mercosur
-}
+annex_data, cas_db, _ = load_data()
+indices = build_indexes(annex_data, cas_db)
 
 # -----------------------------------------------------------
 # INTERFAZ PRINCIPAL
 # -----------------------------------------------------------
+# Separadores de las listas que pega el usuario: se convierten en saltos de línea
+# con str.translate, sin regex. Los espacios no separan ("sodium chloride")
+SEPARADORES_ENTRADA = str.maketrans({",": "\n", ";": "\n"})
+# En fórmulas sólo se separa por comas o líneas
+SEPARADORES_FORMULA = str.maketrans({",": "\n"})
+
+def partir_entrada(texto, separadores=SEPARADORES_ENTRADA):
+    """
+    Separa la entrada del usuario en elementos sin espacios ni vacíos y quita los
+    repetidos (conservando el orden) para no buscar dos veces lo mismo.
+    """
+    elementos = (x.strip() for x in texto.translate(separadores).splitlines())
+    return list(dict.fromkeys(x for x in elementos if x))
+
 st.title("Cosmetic Ingredient Checker")
 st.write("""
 Esta aplicación permite:
@@ -723,31 +1254,33 @@ modo_busqueda = st.sidebar.selectbox(
 # -----------------------------------------------------------
 # 1) Búsqueda por fórmula de ingredientes (con cas_column dinámico)
 # -----------------------------------------------------------
-if modo_busqueda == "Búsqueda por fórmula de ingredientes":
+# Cada modo es un fragmento: al interactuar con sus widgets sólo se vuelve a
+# ejecutar el panel activo, no el script completo
+@st.fragment
+def modo_formula():
     st.header("Búsqueda por fórmula de ingredientes")
     formula_input = st.text_area("Ingredientes (separados por comas o líneas):")
     tipo_busqueda = st.radio("Tipo de búsqueda", ["Aproximada", "Exacta"])
 
     if st.button("Buscar Fórmula"):
-        ingredientes = [i.strip() for i in re.split(r'[\n,]+', formula_input) if i.strip()]
+        ingredientes = partir_entrada(formula_input, SEPARADORES_FORMULA)
         df_res = buscar_ingredientes_por_nombre(ingredientes, exact=(tipo_busqueda == "Exacta"))
-        st.session_state["df_formula"] = df_res
+        # La tabla editable (columna de selección al principio) se arma una sola vez
+        # por búsqueda, no en cada ejecución al marcar una casilla
+        st.session_state["df_formula"] = df_res.assign(Seleccionar=False)[["Seleccionar", *df_res.columns]]
+        # Una fórmula nueva invalida los resultados de restricciones anteriores
+        st.session_state.pop("restricciones_formula", None)
 
     if "df_formula" in st.session_state:
         df = st.session_state["df_formula"]
 
-        # 1) Detectar columna de CAS de forma dinámica
-        cas_column = next((c for c in df.columns if 'cas' in c.lower()), None)
-
-        if not df.empty and cas_column:
-            # 2) Preparar tabla editable
-            df_edit = df.copy()
-            df_edit["Seleccionar"] = False
-            cols = ["Seleccionar"] + [c for c in df_edit.columns if c != "Seleccionar"]
-            df_edit = df_edit[cols]
+        # 1) Columna de CAS de la base, detectada una sola vez en build_indexes
+        cas_column = indices["cas_db_columna_cas"]
 
+        if not df.empty and cas_column in df.columns:
+            # 2) Tabla editable, ya preparada al buscar
             df_editado = st.data_editor(
-                df_edit,
+                df,
                 column_config={
                     "Seleccionar": st.column_config.CheckboxColumn(label="Seleccionar")
                 },
@@ -757,75 +1290,96 @@ if modo_busqueda == "Búsqueda por fórmula de ingredientes":
 
             # 3) Botón que ahora usa la misma función de búsqueda manual
             if st.button("Buscar seleccionados en restricciones"):
-                seleccionadas = df_editado[df_editado["Seleccionar"] == True]
-                # Limpiar y extraer sólo strings no nulos
-                cas_sel = [str(x).strip() for x in seleccionadas[cas_column] if pd.notna(x)]
+                # La columna de casillas ya es booleana: se usa directamente como máscara
+                seleccionadas = df_editado.loc[df_editado["Seleccionar"].to_numpy(dtype=bool)]
+                # Limpiar y extraer sólo strings no nulos, sin repetidos (en orden)
+                cas_sel = seleccionadas[cas_column].dropna().astype(str).str.strip().unique().tolist()
 
                 if not cas_sel:
                     st.warning("Selecciona al menos un CAS válido para buscar.")
                 else:
-                    # Ejecuta la misma búsqueda que en la rama manual
-                    resultados = buscar_cas_en_restricciones(cas_sel, mostrar_info=False)
-
-                    # Mostrar resultados idénticos a la búsqueda manual
-                    st.subheader("Resultados en listados de restricciones")
-                    for cas_n, res in resultados.items():
-                        if res["encontrado"]:
-                            st.markdown(f"### CAS {cas_n}")
-                            for anexo in res["anexos"]:
-                                st.write(f"**{anexo['nombre']}**")
-                                st.dataframe(anexo["data"])
-                                st.markdown("---")
-                        else:
-                            st.warning(f"⚠️ {cas_n} no encontrado en ningún anexo")
-
-                    # Ofrecer descarga de PDF
-                    pdf = generar_reporte_pdf(resultados)
-                    st.download_button(
-                        "📥 Descargar reporte en PDF",
-                        data=pdf,
-                        file_name="reporte_cas_restricciones.pdf",
-                        mime="application/pdf"
-                    )
+                    # Ejecuta la misma búsqueda que en la rama manual; los resultados
+                    # se guardan para que sigan visibles en las siguientes ejecuciones
+                    st.session_state["restricciones_formula"] = {
+                        "resultados": buscar_cas_en_restricciones(cas_sel, mostrar_info=False)
+                    }
+
+            if "restricciones_formula" in st.session_state:
+                guardado = st.session_state["restricciones_formula"]
+
+                # Mostrar resultados idénticos a la búsqueda manual
+                st.subheader("Resultados en listados de restricciones")
+                mostrar_resultados_restricciones(guardado["resultados"])
+
+                # Ofrecer descarga de PDF: se genera recién al hacer clic, así los
+                # bytes no quedan guardados en la sesión entre ejecuciones
+                st.download_button(
+                    "📥 Descargar reporte en PDF",
+                    data=lambda: generar_reporte_pdf(guardado["resultados"]),
+                    file_name="reporte_cas_restricciones.pdf",
+                    mime="application/pdf"
+                )
         else:
             st.info("No se encontraron coincidencias en la base CAS o no hay columna CAS detectada.")
 
 # ------------------------------------------------------------------------
 # 2) Búsqueda en restricciones por CAS
 # ------------------------------------------------------------------------
-elif modo_busqueda == "Búsqueda en restricciones por CAS":
+@st.fragment
+def modo_restricciones():
     st.header("Búsqueda en listados de restricciones por CAS")
     mostrar_info = st.checkbox("Mostrar información de carga", False)
     cas_input = st.text_area("Ingrese números CAS (uno por línea):")
     if st.button("Buscar CAS en restricciones"):
-        cas_list = [x.strip() for x in re.split(r'[\n,;]+', cas_input) if x.strip()]
+        cas_list = partir_entrada(cas_input)
+        invalidos = [cas for cas in cas_list if not cas_valido(cas)]
+        if invalidos:
+            # La búsqueda local es barata y algunos listados traen CAS con erratas,
+            # así que sólo se avisa
+            st.warning("⚠️ Formato o dígito de control no válido: " + ", ".join(invalidos))
         if cas_list:
             if mostrar_info:
-                st.write("".join(f"- {l}\n" for l in info_carga))
+                # Texto plano: las rutas y columnas (con "_") no pasan por Markdown
+                st.text("\n".join(f"- {l}" for l in load_info()))
             resultados = buscar_cas_en_restricciones(cas_list, mostrar_info=False)
             st.subheader("Resultados")
-            for cas_n, res in resultados.items():
-                if res["encontrado"]:
-                    st.markdown(f"### CAS {cas_n}")
-                    for anexo in res["anexos"]:
-                        st.write(f"**{anexo['nombre']}**")
-                        st.dataframe(anexo["data"])
-                        st.markdown("---")
-                else:
-                    st.warning(f"⚠️ {cas_n} no encontrado")
+            mostrar_resultados_restricciones(resultados)
 
 # ------------------------------------------------------------------------
 # 3) Búsqueda en PubChem
 # ------------------------------------------------------------------------
-else:
+@st.fragment
+def modo_pubchem():
     st.header("Búsqueda en PubChem")
     modo = st.radio("Buscar por:", ["Número CAS", "Nombre de ingrediente"])
     prompt = st.text_area("Ingrese valores (uno por línea):")
+    forzar = st.checkbox("Forzar actualización (ignorar resultados guardados)", False)
     if st.button("Buscar en PubChem"):
-        items = [x.strip() for x in re.split(r'[\n,;]+', prompt) if x.strip()]
+        items = partir_entrada(prompt)
+        if modo == "Número CAS":
+            # Los CAS mal escritos se descartan antes de consultar a PubChem
+            invalidos = [cas for cas in items if not cas_valido(cas)]
+            if invalidos:
+                st.warning("⚠️ Se omiten CAS con formato o dígito de control no válido: " + ", ".join(invalidos))
+            items = [cas for cas in items if cas_valido(cas)]
         if items:
-            resultados = buscar_lista_en_pubchem(items, por_cas=(modo=="Número CAS"))
-            for item, data in resultados.items():
-                st.markdown(f"### {item}")
-                mostrar_info_pubchem(data)
-                st.markdown("---")
+            st.session_state["resultados_pubchem"] = buscar_lista_en_pubchem(
+                items, por_cas=(modo=="Número CAS"), forzar=forzar
+            )
+
+    # Los resultados quedan guardados: otras interacciones no los borran ni
+    # obligan a repetir las consultas
+    for item, data in st.session_state.get("resultados_pubchem", {}).items():
+        st.markdown(f"### {item}")
+        mostrar_info_pubchem(data)
+        st.markdown("---")
+
+# -----------------------------------------------------------
+# Sólo se ejecuta el panel del modo elegido
+# -----------------------------------------------------------
+if modo_busqueda == "Búsqueda por fórmula de ingredientes":
+    modo_formula()
+elif modo_busqueda == "Búsqueda en restricciones por CAS":
+    modo_restricciones()
+else:
+    modo_pubchem()
@@ -0,0 +1,59 @@
+import ast
+import io
+import pathlib
+
+import pandas as pd
+
+APP = pathlib.Path(__file__).resolve().parents[1] / "APP_Cosmeticos.py"
+
+
+def cargar_funciones(*nombres):
+    """
+    APP_Cosmeticos.py lanza la interfaz al importarse, así que sólo se compilan
+    las funciones pedidas.
+    """
+    arbol = ast.parse(APP.read_text(encoding="utf-8"))
+    cuerpo = [nodo for nodo in arbol.body
+              if isinstance(nodo, ast.FunctionDef) and nodo.name in nombres]
+    espacio = {"pd": pd}
+    exec(compile(ast.Module(body=cuerpo, type_ignores=[]), str(APP), "exec"), espacio)
+    return [espacio[nombre] for nombre in nombres]
+
+
+deduplicar_nombres, nombres_de_columnas = cargar_funciones(
+    "deduplicar_nombres", "nombres_de_columnas")
+
+
+def test_deduplicar_igual_que_pandas():
+    for encabezado in (["a", "a", "b", "a"], ["a", "a.1", "a"], ["a", "a", "a.1"],
+                       ["x", "x.1", "x", "x"]):
+        csv = ",".join(encabezado) + "\n" + ",".join("1" * len(encabezado))
+        assert deduplicar_nombres(encabezado) == list(pd.read_csv(io.StringIO(csv)).columns)
+
+
+def test_encabezado_duplicado_en_anexo(tmp_path):
+    # Como load_annex: fila de fallback, fila de encabezado con "CAS Number" repetido y datos
+    path = tmp_path / "anexo.xlsx"
+    pd.DataFrame([
+        ["Ref", None, "Fallback", None],
+        ["Reference Number", "CAS Number", None, "CAS Number"],
+        ["1", "50-00-0", "x", "51-84-3"],
+    ]).to_excel(path, header=False, index=False)
+
+    raw = pd.read_excel(path, header=None, dtype=str)
+    df = raw.iloc[2:].reset_index(drop=True)
+    df.columns = nombres_de_columnas(raw.iloc[1].tolist(), raw.iloc[0].tolist())
+
+    assert list(df.columns) == ["Reference Number", "CAS Number", "Fallback", "CAS Number.1"]
+    # Sin fila de fallback, los mismos nombres que pandas con header=0
+    assert nombres_de_columnas(raw.iloc[1].tolist()) == list(pd.read_excel(path, header=1).columns)
+    # Una sola columna por nombre: la indexación devuelve una Serie y Parquet la acepta
+    assert isinstance(df["CAS Number"], pd.Series)
+    df.to_parquet(tmp_path / "anexo.parquet", engine="pyarrow")
+
+
+def test_encabezado_duplicado_en_cas_db():
+    # Como load_cas_db: encabezado con celdas vacías como "" y un "CAS No" repetido
+    encabezado = ["COSING Ref No", "INCI name", "", "CAS No", "CAS No"]
+    assert nombres_de_columnas(encabezado) == [
+        "COSING Ref No", "INCI name", "Unnamed: 2", "CAS No", "CAS No.1"]